@@ -2,26 +2,28 @@ import streamlit as st
 import os
 import json
 import logging
-import time
-from datetime import datetime
+import logging.handlers
+import asyncio
+import hashlib
+from datetime import datetime, timezone
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+import httplib2
+import numpy as np
 import pandas as pd
-import openai
-import requests
-from bs4 import BeautifulSoup
-import base64
-from email.mime.text import MIMEText
 
 # ----------------------
 # Setup
 # ----------------------
 st.set_page_config(page_title="GMC Feed Editor & AI Optimizer", layout="wide")
 logging.basicConfig(
-    filename='app.log',
-    level=logging.DEBUG,
-    format='%(asctime)s %(levelname)s:%(message)s'
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s:%(message)s',
+    handlers=[logging.handlers.RotatingFileHandler('app.log', maxBytes=10_000_000, backupCount=3, delay=True)]
 )
 logger = logging.getLogger(__name__)
 logger.debug("App starting...")
@@ -74,14 +76,46 @@ else:
     except Exception:
         st.error("Failed to parse client_secrets.json. Ensure it is valid JSON.")
         st.stop()
-    logger.debug(f"Using client_secrets file: {CLIENT_SECRETS_FILE}")
+    logger.debug("Using client_secrets file: %s", CLIENT_SECRETS_FILE)
 
-# Rate limit delay between OpenAI calls between OpenAI calls
-RATE_LIMIT_DELAY = float(os.getenv('RATE_LIMIT_DELAY', '0.2'))
+# OpenAI model used for attribute rewriting (e.g. gpt-4 to override)
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+# Request JSON-mode output; disable for models without it, such as gpt-4
+OPENAI_JSON_MODE = os.getenv('OPENAI_JSON_MODE', '1') == '1'
+# Output token budget per product in a prompt
+MAX_TOKENS_PER_PRODUCT = int(os.getenv('MAX_TOKENS_PER_PRODUCT', '400'))
+# OpenAI requests and tokens per minute shared by all concurrent calls
+RPM_LIMIT = int(os.getenv('RPM_LIMIT', '500'))
+TPM_LIMIT = int(os.getenv('TPM_LIMIT', '200000'))
+# Maximum number of OpenAI calls in flight at once
+MAX_CONCURRENCY = int(os.getenv('MAX_CONCURRENCY', '20'))
+# Retries (with exponential backoff) on rate-limit and server errors
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '3'))
+# Number of products marshaled into a single OpenAI prompt
+PRODUCTS_PER_PROMPT = int(os.getenv('PRODUCTS_PER_PROMPT', '5'))
+# Feed size from which the OpenAI Batch API is recommended over real-time calls
+BATCH_THRESHOLD = int(os.getenv('BATCH_THRESHOLD', '1000'))
+# Bytes of each product page downloaded for the AI snippet
+MAX_PAGE_BYTES = int(os.getenv('MAX_PAGE_BYTES', '65536'))
+# Concurrent connections used to scrape product pages
+MAX_SCRAPE_CONNECTIONS = int(os.getenv('MAX_SCRAPE_CONNECTIONS', '50'))
+# Seconds a scraped page snippet is reused before refetching
+SNIPPET_TTL = int(os.getenv('SNIPPET_TTL', '3600'))
+# Attributes rewritten by AI optimization
+AI_FIELDS = ['title','description','productType','googleProductCategory']
+# Titles at least this long are treated as complete and not optimized (0 disables)
+MIN_TITLE_LEN = int(os.getenv('MIN_TITLE_LEN', '0'))
+# Low-cardinality attributes stored as pandas categoricals
+CATEGORY_FIELDS = ['productType','googleProductCategory']
 # OpenAI API key
-openai.api_key = os.getenv('OPENAI_API_KEY')
-if not openai.api_key:
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+if not OPENAI_API_KEY:
     st.warning("OpenAI API key not set; skipping AI optimization.")
+# Pooled keep-alive connections per Google API host, and request timeout in seconds
+GOOGLE_POOL_SIZE = int(os.getenv('GOOGLE_POOL_SIZE', '20'))
+GOOGLE_HTTP_TIMEOUT = int(os.getenv('GOOGLE_HTTP_TIMEOUT', '60'))
+# Entries per Content API products.custombatch call (API maximum is 1000)
+CUSTOMBATCH_SIZE = int(os.getenv('CUSTOMBATCH_SIZE', '1000'))
 # Email recipients
 EMAIL_TO = os.getenv('EMAIL_TO')
 # Backup directory
@@ -127,50 +161,389 @@ def fetch_credentials():
             st.error(f"OAuth error: {e}")
     if 'creds' not in st.session_state:
         authorize()
-    return Credentials(**st.session_state['creds'])
+    return st.session_state['creds']
+
+# ----------------------
+# Google API Clients
+# ----------------------
+class SessionHttp:
+    # httplib2-style facade so googleapiclient sends through a pooled requests
+    # session; AuthorizedSession attaches and refreshes the OAuth token itself
+    def __init__(self, session):
+        self.session = session
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        resp = self.session.request(method, uri, data=body, headers=headers, timeout=GOOGLE_HTTP_TIMEOUT)
+        return httplib2.Response({**resp.headers, 'status': resp.status_code}), resp.content
+
+    def close(self):
+        # The session is cached and shared, so it outlives any one client
+        pass
+
+# Unlike a bare httplib2.Http, the session's connection pool is thread-safe,
+# so concurrent reruns and tabs with the same credentials each get their own
+# keep-alive connection instead of sharing one
+@st.cache_resource(ttl=3600)
+def get_google_http(creds_dict):
+    session = AuthorizedSession(Credentials(**creds_dict))
+    session.mount('https://', HTTPAdapter(pool_connections=GOOGLE_POOL_SIZE, pool_maxsize=GOOGLE_POOL_SIZE))
+    return SessionHttp(session)
+
+# Built once per set of credentials instead of on every rerun; discovery
+# documents ship with google-api-python-client, so no fetch is needed. The ttl
+# evicts clients (and the tokens they hold) of users who have since left
+@st.cache_resource(ttl=3600)
+def get_content_service(creds_dict):
+    return build('content','v2.1',http=get_google_http(creds_dict),cache_discovery=False)
+
+@st.cache_resource(ttl=3600)
+def get_gmail_service(creds_dict):
+    return build('gmail','v1',http=get_google_http(creds_dict),cache_discovery=False)
+
+# Keyed on the credentials so each user only ever sees their own accounts
+@st.cache_data(ttl=300)
+def get_accounts(creds_dict):
+    info = get_content_service(creds_dict).accounts().authinfo().execute()
+    return [a.get('merchantId') or a.get('aggregatorId') for a in info.get('accountIdentifiers', [])]
 
 # ----------------------
 # AI Optimization
 # ----------------------
-def ai_optimize(field, original, url):
-    if not openai.api_key:
-        return original
+@st.cache_resource
+def get_snippet_cache():
+    import diskcache
+    return diskcache.Cache(os.path.join(BACKUP_DIR, 'snippet_cache'))
+
+async def fetch_snippet_async(client, url):
+    from selectolax.lexbor import LexborHTMLParser
     try:
-        resp = requests.get(url, timeout=5)
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        snippet = soup.get_text(' ', strip=True)[:1000]
-    except Exception:
-        snippet = ''
+        body = b''
+        async with client.stream('GET', url) as resp:
+            resp.raise_for_status()
+            async for chunk in resp.aiter_bytes():
+                body += chunk
+                if len(body) >= MAX_PAGE_BYTES:
+                    break
+    except Exception as e:
+        logger.debug("Fetching %s failed: %s", url, e)
+        return None
+    tree = LexborHTMLParser(body[:MAX_PAGE_BYTES])
+    tree.strip_tags(['script', 'style', 'noscript'])
+    return (tree.body or tree.root).text(separator=' ', strip=True)[:1000]
+
+async def fetch_snippets(urls):
+    # Each distinct URL is fetched once, over one pooled HTTP/2 client;
+    # failures come back as None and are not cached. At most
+    # MAX_SCRAPE_CONNECTIONS fetches run at once, so none waits on the pool
+    import httpx
+    cache = get_snippet_cache()
+    snippets = {url: cache.get(url) for url in set(urls)}
+    missing = [url for url, snippet in snippets.items() if snippet is None and url]
+    semaphore = asyncio.Semaphore(MAX_SCRAPE_CONNECTIONS)
+    async with httpx.AsyncClient(
+        http2=True, follow_redirects=True, timeout=httpx.Timeout(5, connect=3, pool=None),
+        limits=httpx.Limits(max_connections=MAX_SCRAPE_CONNECTIONS)
+    ) as client:
+        async def fetch(url):
+            async with semaphore:
+                return await fetch_snippet_async(client, url)
+        fetched = await asyncio.gather(*[fetch(url) for url in missing])
+    for url, snippet in zip(missing, fetched):
+        if snippet is not None:
+            cache.set(url, snippet, expire=SNIPPET_TTL)
+        snippets[url] = snippet
+    return [snippets[url] or '' for url in urls]
+
+def build_optimize_items(pids, values, snippets):
+    return [
+        {'id': pid, **dict(zip(AI_FIELDS, row)), 'snippet': snippet}
+        for pid, row, snippet in zip(pids, values, snippets)
+    ]
+
+def build_optimize_request(items):
     prompt = (
-        f"Optimize the {field} for GMC. Original: '{original}'. "
-        f"Page snippet: '{snippet}'. Return only the optimized {field}."
+        f"Optimize the {', '.join(AI_FIELDS)} of each product below for GMC, "
+        "using its page snippet for context. Return a JSON object with key products: "
+        f"an array with one object per product, with keys id, {', '.join(AI_FIELDS)}.\n"
+        f"Products: {json.dumps(items)}"
     )
-    try:
-        res = openai.ChatCompletion.create(
-            model='gpt-4', messages=[{'role':'user','content':prompt}], max_tokens=150
-        )
-        result = res.choices[0].message.content.strip()
-    except Exception:
-        result = original
-    time.sleep(RATE_LIMIT_DELAY)
-    return result
+    request = {
+        'model': OPENAI_MODEL, 'messages': [{'role':'user','content':prompt}],
+        'max_tokens': MAX_TOKENS_PER_PRODUCT*len(items), 'temperature': 0.2
+    }
+    if OPENAI_JSON_MODE:
+        request['response_format'] = {'type': 'json_object'}
+    return request
+
+def parse_optimized(content):
+    # Tolerate replies wrapped in a ```json fence when JSON mode is off
+    content = content.strip().removeprefix('```json').strip('`')
+    return {str(p['id']): p for p in json.loads(content)['products']}
+
+def merge_optimized(pids, values, parsed):
+    merged = values.copy()
+    for r, pid in enumerate(pids):
+        if str(pid) in parsed:
+            optimized = parsed[str(pid)]
+            merged[r] = [
+                str(optimized[f]) if optimized.get(f) is not None else v
+                for f, v in zip(AI_FIELDS, values[r])
+            ]
+    return merged
+
+def optimizable(df):
+    # Rows without a product page have no snippet to ground a rewrite on
+    mask = df['link'].str.startswith('http', na=False).to_numpy(dtype=bool)
+    if MIN_TITLE_LEN:
+        mask = mask & df['title'].str.len().fillna(0).lt(MIN_TITLE_LEN).to_numpy(dtype=bool)
+    return mask
+
+def set_ai_fields(df, values):
+    # Categoricals reject unseen values in place, so replace the columns and re-encode
+    df[AI_FIELDS] = values
+    df[CATEGORY_FIELDS] = df[CATEGORY_FIELDS].astype('category')
+    return df
+
+def apply_optimized(df, parsed):
+    values = df[AI_FIELDS].to_numpy(dtype=object)
+    return set_ai_fields(df, merge_optimized(df['product_id'].to_numpy(), values, parsed))
+
+@st.cache_resource
+def get_ai_cache():
+    import diskcache
+    return diskcache.Cache(os.path.join(BACKUP_DIR, 'ai_cache'))
+
+def estimate_tokens(request):
+    # About four characters per prompt token, plus the full output budget
+    return len(request['messages'][0]['content'])//4 + request['max_tokens']
+
+def ai_cache_key(item):
+    # Products with the same attributes and page snippet get the same optimization
+    payload = json.dumps([OPENAI_MODEL] + [item[f] for f in AI_FIELDS] + [item['snippet']], default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+async def ai_optimize_products(client, semaphore, rpm_limiter, tpm_limiter, pids, snippets, values):
+    async with semaphore:
+        cache = get_ai_cache()
+        parsed, misses, failed = {}, [], 0
+        for item in build_optimize_items(pids, values, snippets):
+            cached = cache.get(ai_cache_key(item))
+            if cached is not None:
+                parsed[str(item['id'])] = cached
+            else:
+                misses.append(item)
+        logger.debug("Optimizing %d products, %d cached", len(misses), len(parsed))
+        if misses:
+            request = build_optimize_request(misses)
+            reserved = min(estimate_tokens(request), TPM_LIMIT)
+            try:
+                async with rpm_limiter:
+                    await tpm_limiter.acquire(reserved)
+                    res = await client.chat.completions.create(**request)
+                # Charge tokens used beyond the estimate to the window
+                if res.usage and res.usage.total_tokens > reserved:
+                    await tpm_limiter.acquire(min(res.usage.total_tokens - reserved, TPM_LIMIT))
+                optimized = parse_optimized(res.choices[0].message.content)
+            except Exception as e:
+                logger.error("Optimizing %s failed: %s", [item['id'] for item in misses], e)
+                optimized, failed = {}, len(misses)
+            for item in misses:
+                result = {f: v for f, v in optimized.get(str(item['id']), {}).items() if f in AI_FIELDS}
+                # An empty reply would otherwise pin the product as optimized forever
+                if result:
+                    cache.set(ai_cache_key(item), result)
+                    parsed[str(item['id'])] = result
+    return merge_optimized(pids, values, parsed), failed
+
+async def optimize_df(df, on_progress=None):
+    from openai import AsyncOpenAI
+    from aiolimiter import AsyncLimiter
+    async with AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=OPENAI_MAX_RETRIES) as client:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        rpm_limiter = AsyncLimiter(RPM_LIMIT, 60)
+        tpm_limiter = AsyncLimiter(TPM_LIMIT, 60)
+        rows = np.flatnonzero(optimizable(df))
+        logger.info("Optimizing %d of %d products", len(rows), len(df))
+        pids = df['product_id'].to_numpy()[rows]
+        snippets = await fetch_snippets(df['link'].to_numpy()[rows].tolist())
+        results = df[AI_FIELDS].to_numpy(dtype=object, copy=True)
+        optimized = results[rows]
+        async def run(k):
+            chunk = slice(k, k+PRODUCTS_PER_PROMPT)
+            return chunk, await ai_optimize_products(
+                client, semaphore, rpm_limiter, tpm_limiter, pids[chunk], snippets[chunk], optimized[chunk]
+            )
+        done = failed = 0
+        for task in asyncio.as_completed([run(k) for k in range(0, len(rows), PRODUCTS_PER_PROMPT)]):
+            chunk, (values, chunk_failed) = await task
+            optimized[chunk] = values
+            failed += chunk_failed
+            done += len(values)
+            if on_progress:
+                on_progress(done/len(rows))
+    results[rows] = optimized
+    return set_ai_fields(df, results), failed
+
+# ----------------------
+# Batch AI Optimization
+# ----------------------
+def submit_batch_optimize(df):
+    cache = get_ai_cache()
+    rows = df[optimizable(df)]
+    pids = rows['product_id'].to_numpy()
+    values = rows[AI_FIELDS].to_numpy(dtype=object)
+    snippets = asyncio.run(fetch_snippets(rows['link'].tolist()))
+    parsed, misses = {}, []
+    for item in build_optimize_items(pids, values, snippets):
+        cached = cache.get(ai_cache_key(item))
+        if cached is not None:
+            parsed[str(item['id'])] = cached
+        else:
+            misses.append(item)
+    logger.debug("Batch optimizing %d products, %d cached", len(misses), len(parsed))
+    df = apply_optimized(df, parsed)
+    if not misses:
+        return None, df
+    lines, keys = [], {}
+    for k in range(0, len(misses), PRODUCTS_PER_PROMPT):
+        items = misses[k:k+PRODUCTS_PER_PROMPT]
+        keys[f"chunk-{k}"] = {str(item['id']): ai_cache_key(item) for item in items}
+        lines.append(json.dumps({
+            'custom_id': f"chunk-{k}", 'method': 'POST', 'url': '/v1/chat/completions',
+            'body': build_optimize_request(items)
+        }))
+    from openai import OpenAI
+    client = OpenAI(api_key=OPENAI_API_KEY)
+    batch_file = client.files.create(file=('optimize.jsonl', '\n'.join(lines).encode()), purpose='batch')
+    batch = client.batches.create(
+        input_file_id=batch_file.id, endpoint='/v1/chat/completions', completion_window='24h'
+    )
+    # Poll needs each request's cache keys; keep them past the 24h window in case polling is late
+    cache.set(f"batch-{batch.id}", keys, expire=7*24*3600)
+    logger.debug("Submitted batch %s with %d requests", batch.id, len(lines))
+    return batch.id, df
+
+def poll_batch_optimize(df, batch_id):
+    from openai import OpenAI
+    client = OpenAI(api_key=OPENAI_API_KEY)
+    batch = client.batches.retrieve(batch_id)
+    if batch.status != 'completed':
+        return batch.status, df, 0, 0
+    cache = get_ai_cache()
+    keys = cache.get(f"batch-{batch_id}", {})
+    parsed, failed = {}, 0
+    # Requests the Batch API rejected outright only show up in the error file
+    if batch.error_file_id:
+        for line in client.files.content(batch.error_file_id).text.splitlines():
+            result = json.loads(line)
+            logger.error("Batch %s request %s failed: %s", batch_id, result.get('custom_id'), result.get('error'))
+            failed += 1
+    if batch.output_file_id:
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            result = json.loads(line)
+            try:
+                if result['response']['status_code'] != 200:
+                    raise ValueError(f"status {result['response']['status_code']}")
+                optimized = parse_optimized(result['response']['body']['choices'][0]['message']['content'])
+            except Exception as e:
+                logger.error("Batch %s result %s could not be parsed: %s", batch_id, result.get('custom_id'), e)
+                failed += 1
+                continue
+            for pid, key in keys.get(result['custom_id'], {}).items():
+                product = {f: v for f, v in optimized.get(pid, {}).items() if f in AI_FIELDS}
+                if product:
+                    cache.set(key, product)
+            parsed.update(optimized)
+    cache.delete(f"batch-{batch_id}")
+    logger.info("Batch %s applied %d products, %d requests failed", batch_id, len(parsed), failed)
+    return batch.status, apply_optimized(df, parsed), len(parsed), failed
+
+# ----------------------
+# GMC Fetch & Sync
+# ----------------------
+def fetch_products(content, merchant_id):
+    products = []
+    req = content.products().list(merchantId=merchant_id, maxResults=250)
+    while req is not None:
+        page = req.execute()
+        products.extend(page.get('resources', []))
+        req = content.products().list_next(req, page)
+    logger.debug("Fetched %d products for %s", len(products), merchant_id)
+    return products
+
+def backup_feed(df, merchant_id):
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    path = os.path.join(BACKUP_DIR, f"{merchant_id}_{stamp}.parquet")
+    df.to_parquet(path, compression='zstd')
+    logger.debug("Backed up %d products to %s", len(df), path)
+    return path
+
+@st.cache_resource(max_entries=16)
+def load_backup(path):
+    # Only the columns needed for the QA diff; callers must not mutate the result
+    return pd.read_parquet(path, columns=['product_id']+AI_FIELDS)
+
+def sync_products(content, merchant_id, df, on_progress=None):
+    entries = []
+    for pid, record in zip(df['product_id'], df[AI_FIELDS].to_dict('records')):
+        # Missing values aren't valid JSON, and under updateMask a null would
+        # delete the attribute, so only set attributes are sent and masked
+        body = {f: v for f, v in record.items() if pd.notna(v)}
+        if body:
+            entries.append({
+                'batchId': len(entries), 'merchantId': merchant_id, 'productId': pid,
+                'method': 'update', 'updateMask': ','.join(body), 'product': body
+            })
+    synced = failed = 0
+    for k in range(0, len(entries), CUSTOMBATCH_SIZE):
+        chunk = entries[k:k+CUSTOMBATCH_SIZE]
+        try:
+            res = content.products().custombatch(body={'entries': chunk}).execute()
+        except HttpError as e:
+            logger.error("Sync of %d products from %s failed: %s", len(chunk), chunk[0]['productId'], e)
+            failed += len(chunk)
+            res = {}
+        for entry in res.get('entries', []):
+            if entry.get('errors'):
+                logger.error(
+                    "Sync of %s failed: %s",
+                    entries[entry['batchId']]['productId'], entry['errors'].get('message')
+                )
+                failed += 1
+            else:
+                synced += 1
+        if on_progress:
+            on_progress(min(k+CUSTOMBATCH_SIZE, len(entries))/len(entries))
+    return synced, failed
 
 # ----------------------
 # QA & Email
 # ----------------------
 def diff_feed(df_old, df_new):
-    df = df_old.merge(df_new, on='product_id', suffixes=('_old','_new'))
-    mask = ((df['title_old'] != df['title_new']) |
-            (df['description_old'] != df['description_new']) |
-            (df['productType_old'] != df['productType_new']) |
-            (df['googleProductCategory_old'] != df['googleProductCategory_new']))
-    return df[mask]
-
-def send_email(html, creds):
+    import numexpr as ne
+    # Align the backup to the edited feed by product id, then compare as arrays
+    df_old = df_old.set_index('product_id').reindex(df_new['product_id'])
+    n = len(df_new)
+    codes = {}
+    for j, f in enumerate(AI_FIELDS):
+        # Shared integer codes for both sides; missing values are -1 on each
+        both, _ = pd.factorize(pd.concat([df_old[f], df_new[f]], ignore_index=True))
+        codes[f'a{j}'], codes[f'b{j}'] = both[:n].astype(np.int32), both[n:].astype(np.int32)
+    # One fused pass instead of a chain of intermediate boolean arrays
+    mask = ne.evaluate('|'.join(f'(a{j}!=b{j})' for j in range(len(AI_FIELDS))), local_dict=codes)
+    report = {'product_id': df_new['product_id'].to_numpy()[mask]}
+    for f in AI_FIELDS:
+        report[f'{f}_old'] = df_old[f].to_numpy(dtype=object)[mask]
+        report[f'{f}_new'] = df_new[f].to_numpy(dtype=object)[mask]
+    return pd.DataFrame(report)
+
+def send_email(html, creds_dict):
+    import base64
+    from email.mime.text import MIMEText
     if not EMAIL_TO:
         st.error("EMAIL_TO not set")
         return
-    svc = build('gmail','v1',credentials=creds)
+    svc = get_gmail_service(creds_dict)
     msg = MIMEText(html,'html')
     msg['to'] = EMAIL_TO
     msg['subject'] = 'GMC QA Report'
@@ -181,39 +554,66 @@ def send_email(html, creds):
 # ----------------------
 # Main App
 # ----------------------
-def main():
-    st.title("GMC Feed Editor & AI Optimizer")
-    creds = fetch_credentials()
-    content = build('content','v2.1',credentials=creds)
-
-    info = content.accounts().authinfo().execute()
-    accounts = info.get('accountIdentifiers', [])
-    selected = st.sidebar.selectbox("Select GMC Account", accounts)
-
+# Widget interactions in the editor rerun only this fragment, not main()
+@st.fragment
+def editor_fragment(content, selected, creds):
     if st.button("Fetch & Backup Feed"):
-        products = content.products().list(merchantId=selected).execute().get('resources',[])
+        products = fetch_products(content, selected)
         df = pd.json_normalize(products)
         for col in ['id','link','title','description','productType','googleProductCategory']:
             df[col] = df.get(col,'')
         df.rename(columns={'id':'product_id'},inplace=True)
-        st.session_state['df_old'] = df.copy()
-        st.session_state['df'] = df.copy()
+        df[CATEGORY_FIELDS] = df[CATEGORY_FIELDS].astype('category')
+        st.session_state['df_old_path'] = backup_feed(df, selected)
+        st.session_state['df'] = df
         st.success(f"Fetched {len(df)} items.")
 
     if 'df' in st.session_state:
         st.dataframe(st.session_state['df'])
         if st.button("AI Optimize Attributes"):
             df = st.session_state['df']
-            total = len(df)
-            bar = st.progress(0)
-            for i,row in df.iterrows():
-                for f in ['title','description','productType','googleProductCategory']:
-                    df.at[i,f] = ai_optimize(f,row[f],row.get('link',''))
-                bar.progress((i+1)/total)
-            st.session_state['df'] = df
-            st.success("Optimization done.")
+            if not OPENAI_API_KEY:
+                st.warning("OpenAI API key not set; skipping AI optimization.")
+            elif not optimizable(df).any():
+                st.info("No products with a product page link to optimize.")
+            else:
+                bar = st.progress(0)
+                df, failed = asyncio.run(optimize_df(df, bar.progress))
+                st.session_state['df'] = df
+                st.success("Optimization done.")
+                if failed:
+                    st.error(f"{failed} items could not be optimized; see app.log.")
+        if len(st.session_state['df']) >= BATCH_THRESHOLD:
+            st.caption(f"Feeds of {BATCH_THRESHOLD}+ items are cheaper to optimize with the Batch API (results within 24h).")
+        if st.button("Submit Batch Optimize"):
+            if not OPENAI_API_KEY:
+                st.warning("OpenAI API key not set; skipping AI optimization.")
+            elif not optimizable(st.session_state['df']).any():
+                st.info("No products with a product page link to optimize.")
+            else:
+                batch_id, df = submit_batch_optimize(st.session_state['df'])
+                st.session_state['df'] = df
+                if batch_id is None:
+                    st.success("All items were already optimized; applied cached results.")
+                else:
+                    st.session_state['batch_id'] = batch_id
+                    st.success(f"Submitted batch {batch_id}.")
+        if 'batch_id' in st.session_state and st.button("Poll Batch"):
+            status, df, applied, failed = poll_batch_optimize(st.session_state['df'], st.session_state['batch_id'])
+            if status == 'completed':
+                st.session_state['df'] = df
+                del st.session_state['batch_id']
+                if applied:
+                    st.success(f"Batch optimization done; {applied} items optimized.")
+                if failed or not applied:
+                    st.error(f"{failed} batch requests failed; see app.log.")
+            elif status in ('failed','expired','cancelled'):
+                del st.session_state['batch_id']
+                st.error(f"Batch {status}.")
+            else:
+                st.info(f"Batch status: {status}")
         if st.button("Show QA Report"):
-            diff = diff_feed(st.session_state['df_old'],st.session_state['df'])
+            diff = diff_feed(load_backup(st.session_state['df_old_path']),st.session_state['df'])
             if diff.empty:
                 st.info("No changes.")
             else:
@@ -221,17 +621,18 @@ def main():
                 if st.button("Email QA Report"):
                     send_email(diff.to_html(index=False),creds)
         if st.button("Sync to GMC"):
-            df = st.session_state['df']
-            total = len(df)
             bar2 = st.progress(0)
-            count=0
-            for i,row in df.iterrows():
-                content.products().patch(
-                    merchantId=selected,productId=row[   'product_id'   ],body={k:row[k] for k in ['title','description','productType','googleProductCategory']}
-                ).execute()
-                count+=1
-                bar2.progress(count/total)
-            st.success(f"Synced {count} items.")
+            synced, failed = sync_products(content, selected, st.session_state['df'], bar2.progress)
+            st.success(f"Synced {synced} items.")
+            if failed:
+                st.error(f"{failed} items failed to sync; see app.log.")
+
+def main():
+    st.title("GMC Feed Editor & AI Optimizer")
+    creds = fetch_credentials()
+    content = get_content_service(creds)
+    selected = st.sidebar.selectbox("Select GMC Account", get_accounts(creds))
+    editor_fragment(content, selected, creds)
 
 if __name__=='__main__':
     os.environ['OAUTHLIB_INSECURE_TRANSPORT']='1'